@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 """Copyright (c) 2021 Martin Stefanik"""
 
+import functools
+import itertools
 import os
 import re
 import subprocess
@@ -10,6 +12,12 @@ import click
 
 __version__ = "1.0.0"
 
+_BATCH_SIZE = 64  # maximum number of files sent to `lp` at once
+_SIDES = {"1": "one-sided", "2": "two-sided-long-edge"}
+_LP_BASE_OPTS = ("-o", "media=A4", "-o", "collate=true")
+_EXTENSION_RE = re.compile(r"[^\\|()\[\]{}]*\\(\.[A-Za-z0-9]+)\$")
+_LEFT_VALUE_RE = re.compile(rb"(?<!\*)\S*left\S*", flags=re.IGNORECASE)
+
 
 @click.command()
 @click.argument(
@@ -47,8 +55,10 @@ __version__ = "1.0.0"
     type=click.STRING,
     default=None,
     show_default=False,
-    help="Python regular expression to filter out files to be printed. If "
-    "RESOURCE is not a directory, this option is ignored if given.",
+    help="Python regular expression to filter out files to be printed. The "
+    "expression is matched against file names, or against full file paths if "
+    "it contains a '/'. If RESOURCE is not a directory, this option is "
+    "ignored if given.",
 )
 @click.option(
     "-d",
@@ -96,41 +106,45 @@ def main(
         if file_input:  # ignore regex if file is given
             regex = None
         if regex is not None:
-            regex = re.compile(regex)
+            regex = compile_regex(regex)
     except re.error as err:
         raise click.ClickException(
             f"Regular expression error: {str(err).capitalize()}: '{regex}'."
         )
 
-    # Get the list of files that should be printed
+    # Get the files that should be printed in batches of bounded size
     if file_input:
         to_print = [resource]
     else:
         to_print = files_to_print(resource, regex, include_hidden)
-        if len(to_print) == 0:
-            raise click.ClickException(
-                f"No files matching '{regex}' in '{resource}'."
-            )
+    to_print = batches(to_print, _BATCH_SIZE)
+    first_batch = next(to_print, None)
+    if first_batch is None:
+        if regex is None:
+            raise click.ClickException(f"No files in '{resource}'.")
+        raise click.ClickException(
+            f"No files matching '{regex.pattern}' in '{resource}'."
+        )
+    to_print = itertools.chain([first_batch], to_print)
 
     # Print the files
+    command = build_print_command(printer, n_copies, staple, sides)
     if dry_run:
-        _ = build_print_command(printer, n_copies, staple, sides, to_print)
-        click.echo(
-            f"The following files would be sent to printer '{printer}':\n"
-            "  " + "\n  ".join(to_print)
-        )
+        click.echo(f"The following files would be sent to printer '{printer}':")
+        for batch in to_print:
+            click.echo("  " + "\n  ".join(batch))
     else:
-        command = build_print_command(
-            printer, n_copies, staple, sides, to_print
-        )
-        try:
-            subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
-        except FileNotFoundError:
-            raise click.ClickException(
-                "CUPS doesn't seem to be installed: lp unavailable."
-            )
-        except Exception:
-            raise click.ClickException("Unknown error.")
+        for batch in to_print:  # the walk continues between the batches
+            try:
+                subprocess.run(
+                    command + batch, stdout=subprocess.DEVNULL, check=True
+                )
+            except FileNotFoundError:
+                raise click.ClickException(
+                    "CUPS doesn't seem to be installed: lp unavailable."
+                )
+            except Exception:
+                raise click.ClickException("Unknown error.")
 
 
 def prompt_for_printer(printers):
@@ -146,14 +160,18 @@ def prompt_for_printer(printers):
     return printers[int(printer_number) - 1]
 
 
+@functools.lru_cache(maxsize=1)
 def get_available_printers():
     """Get the list of available printers."""
     try:
         pr = subprocess.run(
-            ["/usr/bin/lpstat", "-a"], check=True, capture_output=True
+            ["/usr/bin/lpstat", "-a"],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
         )
-        printers = pr.stdout.decode("UTF-8").splitlines()
-        printers = [p.split(" ")[0] for p in printers]
+        printers = pr.stdout.splitlines()
+        printers = tuple(p.partition(b" ")[0].decode("UTF-8") for p in printers)
     except FileNotFoundError:
         raise click.ClickException(
             "CUPS doesn't seem to be installed: lpstat unavailable."
@@ -164,39 +182,81 @@ def get_available_printers():
     return printers
 
 
+@functools.lru_cache(maxsize=128)
+def compile_regex(pattern):
+    """Compile a regular expression, reusing previously compiled patterns."""
+    return re.compile(pattern)
+
+
 def files_to_print(dir, regex, include_hidden):
-    """Get a list of files in a directory whose names conform to a regex."""
-    if regex is not None:
-        to_print = []
-        for f in files(dir, include_hidden):
-            if os.path.isfile(f) and regex.search(f):
-                to_print.append(f)
-    else:
-        to_print = list(files(dir, include_hidden))
+    """
+    Generate files in a directory whose names conform to a regex. The regex
+    is expected to be compiled already (see `compile_regex`) or None.
+    """
+    match_path = regex is not None and os.sep in regex.pattern
+    suffixes = ("",) if regex is None else required_suffixes(regex)
+    for e in files(dir, include_hidden):
+        try:
+            is_file = e.is_file()
+        except OSError:  # e.g. symlink loops, like os.path.isfile
+            is_file = False
+        if not is_file:  # directories cannot be printed
+            continue
+        name = e.path if match_path else e.name
+        # The cheap suffix test rejects most files before the regex is run
+        if regex is None or (name.endswith(suffixes) and regex.search(name)):
+            yield e.path
 
-    return to_print
+
+def required_suffixes(regex):
+    """
+    Get the suffixes one of which each string matched by a regex ends with.
+    For a regex ending with a literal file extension and '$', these are the
+    extension and the extension followed by a newline (which '$' also allows).
+    If no such suffix can be determined, the empty suffix is returned.
+    """
+    match = _EXTENSION_RE.fullmatch(regex.pattern)
+    if match is None:
+        return ("",)
+    return (match.group(1), match.group(1) + "\n")
 
 
 def files(dir, include_hidden):
-    """Generate files and directories located under a given directory."""
-    for root, dirs, files in os.walk(dir):
-        if not include_hidden:
-            if re.search(r"/\.", root) is not None:
-                continue
-            entries = [e for e in dirs + files if not e.startswith(".")]
-        else:
-            entries = dirs + files
-        for e in entries:
-            yield os.path.join(root, e)
-
-
-def build_print_command(printer, n_copies, staple, sides, to_print):
-    """Build an `lp` print command based on the user input."""
+    """Generate entries for files and directories under a given directory."""
+    # os.scandir is used directly instead of os.walk/os.fwalk, which only
+    # report names and would need another stat to tell regular files apart
+    stack = [dir]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:  # skip unreadable directories like os.walk does
+            continue
+        subdirs = []
+        with it:
+            for e in it:
+                if not include_hidden and e.name.startswith("."):
+                    continue
+                if e.is_dir(follow_symlinks=False):
+                    subdirs.append(e.path)
+                yield e
+        stack.extend(reversed(subdirs))  # keep the top-down order of os.walk
+
+
+def batches(iterable, size):
+    """Split an iterable into consecutive lists of at most a given size."""
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+
+def build_print_command(printer, n_copies, staple, sides):
+    """
+    Build an `lp` print command based on the user input. The files to print
+    are to be appended to the returned command.
+    """
     stapling_option = set_stapling_option(printer, staple)
-    if sides == "1":
-        sides = "one-sided"
-    else:
-        sides = "two-sided-long-edge"
     command = [
         "/usr/bin/lp",
         "-d",
@@ -204,28 +264,25 @@ def build_print_command(printer, n_copies, staple, sides, to_print):
         "-n",
         str(n_copies),
         "-o",
-        f"sides={sides}",
-        "-o",
-        "media=A4",
-        "-o",
-        "collate=true",
+        f"sides={_SIDES[sides]}",
+        *_LP_BASE_OPTS,
     ]
-    if staple and stapling_option is not None:
+    if stapling_option is not None:
         command.extend(["-o", stapling_option])
     command.extend(["--"])
-    command.extend(to_print)
 
     return command
 
 
-def set_stapling_option(printer, staple):
-    """Get the printer-specific name of the option for staping and set it."""
-    pattern = re.compile(r"staple", flags=re.IGNORECASE)
+@functools.lru_cache(maxsize=8)
+def get_printer_options(printer):
+    """Get the undecoded lines listing the printer-specific options."""
     try:
         pr = subprocess.run(
             ["/usr/bin/lpoptions", "-p", printer, "-l"],
             check=True,
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
         )
     except FileNotFoundError:
         raise click.ClickException(
@@ -233,24 +290,25 @@ def set_stapling_option(printer, staple):
         )
     except Exception:
         raise click.ClickException("Unknown error.")
-    options = pr.stdout.decode("UTF-8").splitlines()
-    stapling = [opt for opt in options if pattern.search(opt) is not None]
 
-    if not staple and not stapling:
+    return tuple(pr.stdout.splitlines())
+
+
+def set_stapling_option(printer, staple):
+    """Get the printer-specific name of the option for staping and set it."""
+    if not staple:  # no need to query the printer options
         return None
-    elif staple and not stapling:
+    options = get_printer_options(printer)
+    stapling = next((opt for opt in options if b"staple" in opt.lower()), None)
+    if stapling is None:
         raise click.ClickException(
             f"Printer '{printer}' has no stapling functionality."
         )
-    name = stapling[0].split("/")[0]  # stapling option name
-    values = stapling[0].split(":")[1]  # possible values for the option
+    name = stapling.partition(b"/")[0].decode("UTF-8")  # option name
+    values = stapling.rpartition(b":")[2]  # possible values for the option
 
     # Set the stapling option to the desired value
-    if staple:  # `stapling` is True at this point
-        pattern = re.compile(r"(?<!\*)\S*left\S*", flags=re.IGNORECASE)
-        target_value = pattern.search(values).group(0)
-    else:
-        target_value = "None"
+    target_value = _LEFT_VALUE_RE.search(values).group(0).decode("UTF-8")
 
     return f"{name}={target_value}"
 